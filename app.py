@@ -1,16 +1,18 @@
 import streamlit as st
 import pandas as pd
 import io
+import os
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 import re
-import gspread
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from config import STATIC_COLUMNS, DEFAULT_SHEET_NAME, DEFAULT_HEADER_ROW, DEFAULT_MAPPING_SHEET_ID
-from utils import extract_folder_id, download_files_from_drive, is_static_column, fuzzy_match_activity
-from processing import process_single_file
-from transformations import transform_to_output_schema, transform_to_opcen_format
+from config import STATIC_COLUMNS, DEFAULT_SHEET_NAME, DEFAULT_HEADER_ROW, DEFAULT_MAPPING_SHEET_ID, GOOGLE_API_RETRIES
+from utils import extract_folder_id, download_files_from_drive, get_credentials, get_sheet_values, normalize_column_names
+from processing import EXCEL_ENGINE, init_worker, process_file_bytes, process_single_file, serialize_mapping
+from transformations import transform_to_format
 
 # Create a simple wrapper that skips the pd.read_excel step
 class GoogleSheetWrapper:
@@ -18,10 +20,124 @@ class GoogleSheetWrapper:
         self.df = dataframe
         self.name = name
 
+class ResultCache:
+    """Small thread-safe LRU cache for processing results, shared by all sessions"""
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+    
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+# Cache-miss sentinel (None is a valid cached result: "no valid data")
+_MISSING = object()
+
 import json
 credentials_dict = dict(st.secrets["gcp_service_account"])
 
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_default_mapping(sheet_id, _credentials_dict):
+    """
+    Load the default activity mapping table from Google Sheets.
+    Cached for an hour so widget reruns don't hit the Sheets API again.
+    (_credentials_dict is excluded from the cache key.)
+    """
+    # One values.get round trip instead of gspread's open/worksheet/read sequence
+    rows = get_sheet_values(sheet_id, _credentials_dict)
+    if not rows:
+        return pd.DataFrame()
+    return pd.DataFrame(rows[1:], columns=rows[0])
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def load_uploaded_mapping(file_bytes, file_name):
+    """
+    Parse an uploaded custom mapping table.
+    Keyed on the file contents, so reruns with the same upload skip the parse.
+    """
+    if file_name.endswith('.csv'):
+        return pd.read_csv(io.BytesIO(file_bytes))
+    return pd.read_excel(io.BytesIO(file_bytes), engine=EXCEL_ENGINE)
+
+
+@st.cache_resource
+def get_result_cache():
+    """Per-file processing results keyed by content hash and settings"""
+    return ResultCache()
+
+
+def dataframe_signature(df):
+    """Content hash of a DataFrame (values and column names), for use in cache keys"""
+    row_hashes = pd.util.hash_pandas_object(df, index=False).values
+    return hashlib.sha256(row_hashes.tobytes() + repr(list(df.columns)).encode()).hexdigest()
+
+
+# Download format label -> (file extension, MIME type)
+DOWNLOAD_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Excel (.xlsx)": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "CSV (gzip)": ("csv.gz", "application/gzip"),
+}
+
+
+def concat_outputs(outputs):
+    """Combine per-file outputs into one DataFrame"""
+    if len(outputs) == 1:
+        # Single file/sheet - nothing to concatenate. The frame is returned as is
+        # (not renumbered): downloads are written without the index, and it may be
+        # shared through the result cache, so it must not be modified
+        return outputs[0]
+    return pd.concat(outputs, ignore_index=True, sort=False)
+
+
+# Widget interactions rerun the whole script - cache the serialized file so
+# reruns with unchanged outputs don't rebuild it
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_download(outputs, download_format):
+    """Serialize the per-file outputs in the chosen download format"""
+    output = io.BytesIO()
+    if download_format == "Excel (.xlsx)":
+        # Each file's output is appended to the sheet as-is, so the full consolidated
+        # frame never has to be built. constant_memory mode is not used: it only
+        # supports row-by-row writes, and pandas writes column by column
+        columns = pd.Index(dict.fromkeys(col for df in outputs for col in df.columns))
+        # strings_to_urls=False writes URL-looking text as plain strings (as openpyxl did)
+        # instead of turning each into a hyperlink object
+        with pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs={'options': {'strings_to_urls': False}}) as writer:
+            startrow = 0
+            for i, df in enumerate(outputs):
+                if not df.columns.equals(columns):
+                    df = df.reindex(columns=columns)
+                df.to_excel(writer, index=False, sheet_name='Mapped Activities',
+                            startrow=startrow, header=(i == 0))
+                startrow += len(df) + (i == 0)
+        return output.getvalue()
+
+    df = concat_outputs(outputs)
+    if download_format == "CSV":
+        df.to_csv(output, index=False)
+    elif download_format == "CSV (gzip)":
+        df.to_csv(output, index=False, compression='gzip')
+    else:
+        # Arrow needs one type per column; mapping tables can mix numbers and text
+        object_cols = df.select_dtypes(include='object').columns
+        df.astype({col: 'string' for col in object_cols}).to_parquet(output, index=False, engine='pyarrow', compression='snappy')
+    return output.getvalue()
+
 
 st.set_page_config(page_title="PRC: Chapter Statistical Report - Data Consolidation", layout="wide")
 
@@ -131,9 +247,10 @@ Processing time depends on file size and number of files (typically 10-30 second
 - **Check:** Both mapping and beneficiary issues present
 
 **Download:**
+- Choose a download format: CSV (default), Excel (.xlsx), Parquet or gzipped CSV
 - Click "Download Consolidated Report"
-- File saved as: `DSR_Consolidated_YYYYMMDD_HHMMSS.xlsx`
-- Contains one sheet with all consolidated data
+- File saved as: `DSR_Consolidated_YYYYMMDD_HHMMSS.csv` (or `.xlsx` / `.parquet` / `.csv.gz`)
+- Contains all consolidated data in a single table
 
 ---
 
@@ -271,19 +388,12 @@ with tab2:
     )
 
     if use_default_mapping:
-        # Load from Google Sheets using service account
-        from google.oauth2.service_account import Credentials
-        import gspread
-        
-        SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
-        creds = Credentials.from_service_account_info(credentials_dict, scopes=SCOPES)
-        sheets_client = gspread.authorize(creds)
-        
-        # Open the sheet and read data
-        sheet = sheets_client.open_by_key(DEFAULT_MAPPING_SHEET_ID)
-        worksheet = sheet.get_worksheet(0)  # First sheet
-        data = worksheet.get_all_records()
-        mapping_df = pd.DataFrame(data)
+        # Pick up sheet edits before the hourly cache expiry
+        if st.button("🔄 Refresh mapping", help="Reload the default mapping table from Google Sheets"):
+            load_default_mapping.clear()
+
+        # Load from Google Sheets using service account (cached across reruns)
+        mapping_df = load_default_mapping(DEFAULT_MAPPING_SHEET_ID, credentials_dict)
         
         st.success(f"✅ Using default mapping table with {len(mapping_df)} activities")
     else:
@@ -298,10 +408,7 @@ with tab2:
             st.warning("⚠️ Please upload a mapping table to continue")
             st.stop()
         
-        if mapping_file.name.endswith('.csv'):
-            mapping_df = pd.read_csv(mapping_file)
-        else:
-            mapping_df = pd.read_excel(mapping_file)
+        mapping_df = load_uploaded_mapping(mapping_file.getvalue(), mapping_file.name)
         
         st.success(f"✅ Loaded custom mapping table with {len(mapping_df)} activities")
 
@@ -342,10 +449,9 @@ with tab2:
                 df = read_google_sheet(sheet_id, credentials_dict, sheet_name, header_row)
                 
                 # Standardize column names
-                df.columns = df.columns.str.strip().str.replace(r'\s+', ' ', regex=True)
+                df.columns = normalize_column_names(df.columns)
                 
                 # Process directly without converting to Excel
-                from processing import process_single_file
                 
                 # Create a simple wrapper that skips the pd.read_excel step
                 #class GoogleSheetWrapper:
@@ -362,10 +468,9 @@ with tab2:
                 try:
                     from googleapiclient.discovery import build
                     from googleapiclient.http import MediaIoBaseDownload
-                    from google.oauth2.service_account import Credentials
                     
                     SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
-                    creds = Credentials.from_service_account_info(credentials_dict, scopes=SCOPES)
+                    creds = get_credentials(credentials_dict, SCOPES)
                     service = build('drive', 'v3', credentials=creds)
                     
                     # Download the file
@@ -375,35 +480,12 @@ with tab2:
                     
                     done = False
                     while not done:
-                        status, done = downloader.next_chunk()
+                        status, done = downloader.next_chunk(num_retries=GOOGLE_API_RETRIES)
                     
                     file_buffer.seek(0)
+                    file_buffer.name = "DriveExcel.xlsx"
                     
-                    class MemoryFile:
-                        def __init__(self, buffer, name):
-                            self.buffer = buffer
-                            self.name = name
-                            
-                        def read(self, size=-1):
-                            return self.buffer.read(size)
-                            
-                        def seek(self, pos, whence=0):
-                            return self.buffer.seek(pos, whence)
-                        
-                        def tell(self):
-                            return self.buffer.tell()
-                        
-                        def seekable(self):  # ← Add this
-                            return True
-                        
-                        def readable(self):  # ← And this while we're at it
-                            return True
-                        
-                        def writable(self):  # ← And this
-                            return False
-                    
-                    memory_file = MemoryFile(file_buffer, "DriveExcel.xlsx")
-                    files_to_process = [memory_file]
+                    files_to_process = [file_buffer]
                     st.success(f"✅ Successfully downloaded Excel file from Drive")
                     
                 except Exception as drive_error:
@@ -428,90 +510,155 @@ with tab2:
             st.stop()
 
     # Process all files (rest of your code stays the same from here)
-    if files_to_process:
-        st.info(f"🔄 Processing {len(files_to_process)} file(s)...")
+    # Nothing to do - skip the pools, progress widgets and result cache entirely
+    if not files_to_process:
+        st.stop()
 
-        #import os
-        #if os.path.exists('/tmp/debug_fuzzy.txt'):
-        #    os.remove('/tmp/debug_fuzzy.txt')
-        
-        all_outputs = []
-        progress_bar = st.progress(0)
-        
-    for idx, file in enumerate(files_to_process):
+    st.info(f"🔄 Processing {len(files_to_process)} file(s)...")
+
+    # Outputs are keyed by file index so the consolidated order matches the input order
+    outputs_by_idx = {}
+    completed = 0
+    progress_bar = st.progress(0)
+    progress_status = st.empty()
+    last_progress_update = [0.0]
+    # Per-file messages are shown together after processing rather than sent
+    # to the browser one by one
+    file_messages = []
+
+    def collect_result(idx, file, result):
+        """Record one file's (processed rows, output_df) result and report it"""
+        if result is not None:
+            processed_rows, output_df = result
+            file_messages.append((idx, 'success', f"✅ {file.name}: processed {processed_rows} rows, transformed to {len(output_df)} output rows"))
+            outputs_by_idx[idx] = output_df
+        else:
+            file_messages.append((idx, 'warning', f"⚠️ No valid data found in {file.name}"))
+
+    def update_progress(completed):
+        """Redraw progress at most ~10 times a second, and always for the last file"""
+        now = time.monotonic()
+        if completed == len(files_to_process) or now - last_progress_update[0] >= 0.1:
+            progress_bar.progress(completed / len(files_to_process))
+            progress_status.text(f"Processed {completed}/{len(files_to_process)} file(s)")
+            last_progress_update[0] = now
+
+    def report_error(file, e):
+        file_name = file.name if hasattr(file, 'name') else 'Unknown file'
+        st.error(f"❌ Error processing {file_name}: {str(e)}")
+        st.exception(e)
+
+    # Google Sheets are already DataFrames, everything else is parsed in worker processes
+    sheet_files = [(idx, file) for idx, file in enumerate(files_to_process) if isinstance(file, GoogleSheetWrapper)]
+    excel_files = [(idx, file) for idx, file in enumerate(files_to_process) if not isinstance(file, GoogleSheetWrapper)]
+
+    for idx, file in sheet_files:
         try:
-            if isinstance(file, GoogleSheetWrapper):
-                st.write(f"**Processing:** {file.name}")
-                df = file.df
-                
-                # Identify static vs activity columns
-                activity_cols = [col for col in df.columns if not is_static_column(col, STATIC_COLUMNS)]
-                existing_static_cols = [col for col in df.columns if is_static_column(col, STATIC_COLUMNS)]
-                
-                # Unpivot
-                melted_df = pd.melt(df, id_vars=existing_static_cols, value_vars=activity_cols, 
-                                var_name='RawItemName', value_name='Count')
-                
-                # Add source tracking
-                melted_df['Source_Filename'] = file.name
-                melted_df['Source_Row_Number'] = melted_df.index + header_row + 1
-
-                # Clean - convert to numeric (blanks become NaN)
-                melted_df['Count'] = pd.to_numeric(melted_df['Count'], errors='coerce')
-
-                # Remove NaN and zeros
-                melted_df = melted_df[melted_df['Count'].notna()]
-                melted_df = melted_df[melted_df['Count'] > 0]
-                
-                if not melted_df.empty:
-                    # Fuzzy match and merge
-                    melted_df['MatchedActivity'] = melted_df['RawItemName'].apply(
-                        lambda x: fuzzy_match_activity(x, mapping_df) or x
-                    )
-                    processed_df = melted_df.merge(mapping_df, left_on='MatchedActivity', 
-                                                right_on='RawItemName', how='left')
-                else:
-                    processed_df = None
-            
-            else:
-                # Regular file processing
-                st.write(f"**Processing file:** {file.name}")
-                processed_df = process_single_file(file, mapping_df, sheet_name, header_row, STATIC_COLUMNS)
-            
-            # Transform the processed data (common for both paths)
+            processed_df = process_single_file(file.df, mapping_df, sheet_name, header_row,
+                                               STATIC_COLUMNS, source_name=file.name)
             if processed_df is not None:
-                st.write(f"✅ Processed {len(processed_df)} rows")
-                
-                if output_format == "DMS 5W":
-                    output_df = transform_to_output_schema(processed_df)
-                elif output_format == "OpCen DSR Daily Assistance":
-                    output_df = transform_to_opcen_format(processed_df)
-                
-                all_outputs.append(output_df)
-                st.write(f"✅ Transformed to {len(output_df)} output rows")
+                collect_result(idx, file, (len(processed_df), transform_to_format(processed_df, output_format)))
             else:
-                st.warning(f"⚠️ No valid data found in file")
+                collect_result(idx, file, None)
         
         except Exception as e:
-            file_name = file.name if hasattr(file, 'name') else 'Unknown file'
-            st.error(f"❌ Error processing {file_name}: {str(e)}")
-            st.exception(e)
+            report_error(file, e)
         
         # Update progress
-        progress_bar.progress((idx + 1) / len(files_to_process))
+        completed += 1
+        update_progress(completed)
+
+    if excel_files:
+        result_cache = get_result_cache()
+        mapping_signature = dataframe_signature(mapping_df)
         
+        # Reuse cached results where possible - processed data only depends on the file
+        # contents, read settings and mapping table, so changing just the output format
+        # only re-runs the transform
+        pending = []
+        for idx, file in excel_files:
+            file.seek(0)
+            file_bytes = file.read()
+            process_key = (hashlib.sha256(file_bytes).hexdigest(), sheet_name, header_row, mapping_signature)
+            output_key = process_key + (output_format,)
+            
+            cached_result = result_cache.get(output_key, _MISSING)
+            cached_processed = result_cache.get(process_key, _MISSING)
+            if cached_result is not _MISSING:
+                collect_result(idx, file, cached_result)
+            elif cached_processed is None:
+                collect_result(idx, file, None)
+            elif cached_processed is not _MISSING:
+                pending.append((idx, None, cached_processed, process_key, output_key))
+            else:
+                pending.append((idx, file_bytes, None, process_key, output_key))
+            
+            if cached_result is not _MISSING or cached_processed is None:
+                completed += 1
+                update_progress(completed)
+        
+        if pending:
+            # Files are independent and parsing is CPU-bound, so fan out across cores.
+            # The mapping table is serialized once here and handed to each worker via
+            # the initializer (rather than pickling the DataFrame per worker or per file).
+            # With at most one file to parse there is nothing to fan out, so threads
+            # avoid the cost of starting worker processes. Threads share this server
+            # process with other sessions, so they get the mapping table passed in
+            # instead of through init_worker's module globals.
+            files_to_parse = sum(1 for item in pending if item[1] is not None)
+            max_workers = min(os.cpu_count() or 1, len(pending))
+            if files_to_parse > 1:
+                mapping_payload = serialize_mapping(mapping_df)
+                executor = ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                               initargs=(mapping_payload,))
+                worker_mapping_df = None
+            else:
+                executor = ThreadPoolExecutor(max_workers=max_workers)
+                worker_mapping_df = mapping_df
+            with executor:
+                futures = {}
+                for idx, file_bytes, processed_df, process_key, output_key in pending:
+                    file = files_to_process[idx]
+                    future = executor.submit(
+                        process_file_bytes, file_bytes, file.name,
+                        sheet_name, header_row, STATIC_COLUMNS, output_format, processed_df,
+                        worker_mapping_df
+                    )
+                    futures[future] = (idx, process_key, output_key)
+                
+                for future in as_completed(futures):
+                    idx, process_key, output_key = futures[future]
+                    file = files_to_process[idx]
+                    try:
+                        processed_df, output_df = future.result()
+                        result = (len(processed_df), output_df) if processed_df is not None else None
+                        result_cache.put(process_key, processed_df)
+                        result_cache.put(output_key, result)
+                        collect_result(idx, file, result)
+                    except Exception as e:
+                        report_error(file, e)
+                    
+                    # Update progress
+                    completed += 1
+                    update_progress(completed)
+
+    all_outputs = [outputs_by_idx[idx] for idx in sorted(outputs_by_idx)]
+
+    if file_messages:
+        has_warnings = any(level == 'warning' for _, level, _ in file_messages)
+        with st.expander(f"📄 File details ({len(file_messages)})", expanded=has_warnings):
+            for _, level, message in sorted(file_messages, key=lambda item: item[0]):
+                if level == 'warning':
+                    st.warning(message)
+                else:
+                    st.write(message)
+        
+
     # Check if we got any valid data
     if not all_outputs:
         st.error("❌ No valid data found in the uploaded files")
         st.stop()
     
-    # Concatenate all outputs
-    if all_outputs:
-        final_df = pd.concat(all_outputs, ignore_index=True, sort=False)
-    else:
-        st.error("❌ No valid data found")
-        st.stop()
-
     st.success(f"✅ Successfully processed {len(files_to_process)} file(s)!")
 
     # Upload to BigQuery
@@ -521,7 +668,7 @@ with tab2:
     #from bigquery_utils import upload_to_bigquery
         
     #    total_affected, new_count, updated_count = upload_to_bigquery(
-        #       final_df, 
+        #       concat_outputs(all_outputs), 
         #      credentials_dict, 
         #     uploaded_by="Streamlit User"  # TODO: Add user tracking
         #)
@@ -534,40 +681,32 @@ with tab2:
 # Summary statistics
     # Summary statistics
     st.subheader("📊 Summary")
-    st.metric("Total Records", len(final_df))
+    st.metric("Total Records", sum(len(df) for df in all_outputs))
 
-    # ADD THIS HERE - Debug file download
-    #import os
-    #if os.path.exists('/tmp/debug_fuzzy.txt'):
-    #    with open('/tmp/debug_fuzzy.txt', 'r') as f:
-    #        debug_content = f.read()
-        
-    #    st.download_button(
-    #        label="📥 Download Debug Log",
-    #        data=debug_content,
-    #        file_name="fuzzy_debug.txt",
-    #        mime="text/plain"
-    #    )
-    
     # Show preview
     st.subheader("📋 Final Output Preview")
-    st.dataframe(final_df.head(20))
-
-    # Create CSV file
-    output = io.BytesIO()
-    final_df.to_csv(output, index=False)
-    output.seek(0)
+    # Only the first 20 rows are shown, so only the leading files need combining
+    st.dataframe(pd.concat([df.head(20) for df in all_outputs[:20]], ignore_index=True, sort=False).head(20))
 
     # Download section
     st.markdown("<h3 style='text-align: center;'>📥 Download</h3>", unsafe_allow_html=True)
 
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
+        download_format = st.radio(
+            "Download format:",
+            list(DOWNLOAD_FORMATS),
+            horizontal=True,
+            help="CSV opens anywhere; Parquet and gzipped CSV are much smaller and faster for large reports"
+        )
+        extension, mime = DOWNLOAD_FORMATS[download_format]
+
+        # Only the selected format is serialized
         st.download_button(
             label="📥 Download Consolidated Report",
-            data=output,
-            file_name=f"DSR_Consolidated_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",  # ← Changed to .csv
-            mime="text/csv",  # ← Changed mime type
+            data=build_download(all_outputs, download_format),
+            file_name=f"DSR_Consolidated_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}",
+            mime=mime,
             type="primary",
             use_container_width=True
         )
@@ -1,8 +1,15 @@
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
 from google.oauth2.service_account import Credentials
 import pandas as pd
+import numpy as np
 import hashlib
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
+
+# Rows per load job - bounds the Parquet buffer built client-side for each job
+LOAD_BATCH_SIZE = 10000
+
 
 def upload_to_bigquery(df, credentials_dict, uploaded_by="Unknown"):
     """
@@ -29,52 +36,72 @@ def upload_to_bigquery(df, credentials_dict, uploaded_by="Unknown"):
     # Prepare the dataframe for BigQuery
     bq_df = prepare_for_bigquery(df, uploaded_by)
     
-    # Get existing hashes from BigQuery to check for duplicates
-    existing_hashes = get_existing_hashes(client, table_id)
-    
-    # Split into new records and updates
-    new_records = bq_df[~bq_df['record_hash'].isin(existing_hashes)]
-    update_records = bq_df[bq_df['record_hash'].isin(existing_hashes)]
+    if len(bq_df) == 0:
+        return 0, 0, 0
     
-    rows_affected = 0
+    # Check which of this upload's hashes are already in BigQuery (for reporting)
+    existing_hashes = get_existing_hashes(client, table_id, bq_df['record_hash'].unique())
+    updated_count = int(bq_df['record_hash'].isin(existing_hashes).sum())
+    new_count = len(bq_df) - updated_count
     
-    # Insert new records
-    if len(new_records) > 0:
+    try:
+        target_table = client.get_table(table_id)
+    except NotFound:
+        # First upload - nothing to replace, the load job creates the table
         job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
             write_disposition="WRITE_APPEND",
         )
-        job = client.load_table_from_dataframe(new_records, table_id, job_config=job_config)
-        job.result()  # Wait for completion
-        rows_affected += len(new_records)
+        load_in_batches(client, bq_df, table_id, job_config)
+        return len(bq_df), new_count, updated_count
     
-    # Update existing records
-    if len(update_records) > 0:
-        # For updates, we'll delete old records and insert new ones
-        # (BigQuery doesn't have native UPDATE from DataFrame)
-        hashes_to_update = update_records['record_hash'].tolist()
-        
-        # Delete old records
-        delete_query = f"""
-        DELETE FROM `{table_id}`
-        WHERE record_hash IN UNNEST(@hashes)
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ArrayQueryParameter("hashes", "STRING", hashes_to_update)
-            ]
-        )
-        delete_job = client.query(delete_query, job_config=job_config)
-        delete_job.result()
-        
-        # Insert updated records
+    # Stage the whole upload with load jobs (Arrow/Parquet, no per-row streaming
+    # quota), using the target's column types so the MERGE lines up
+    staging_id = f"{table_id}_stage_{uuid.uuid4().hex}"
+    schema = [field for field in target_table.schema if field.name in bq_df.columns]
+    staging_table = bigquery.Table(staging_id, schema=schema)
+    staging_table.expires = datetime.utcnow() + timedelta(hours=1)  # cleanup fallback
+    client.create_table(staging_table)
+    
+    try:
         job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            schema=schema,
             write_disposition="WRITE_APPEND",
         )
-        job = client.load_table_from_dataframe(update_records, table_id, job_config=job_config)
-        job.result()
-        rows_affected += len(update_records)
+        load_in_batches(client, bq_df, staging_id, job_config)
+        
+        # One atomic MERGE replaces the old DELETE + INSERT jobs: existing rows with
+        # an uploaded hash are deleted and every uploaded row is inserted. ON FALSE
+        # keeps the old semantics (duplicates within an upload are all inserted)
+        columns = ', '.join(f'`{col}`' for col in bq_df.columns)
+        merge_query = f"""
+        MERGE `{table_id}` T
+        USING `{staging_id}` S
+        ON FALSE
+        WHEN NOT MATCHED BY SOURCE AND T.record_hash IN (SELECT record_hash FROM `{staging_id}`) THEN
+            DELETE
+        WHEN NOT MATCHED THEN
+            INSERT ({columns}) VALUES ({columns})
+        """
+        merge_job = client.query(merge_query)
+        merge_job.result()
+    finally:
+        client.delete_table(staging_id, not_found_ok=True)
     
-    return rows_affected, len(new_records), len(update_records)
+    return len(bq_df), new_count, updated_count
+
+
+def load_in_batches(client, df, table_id, job_config):
+    """
+    Append df to table_id with one load job per LOAD_BATCH_SIZE rows, so only one
+    batch is serialized to Parquet at a time
+    """
+    for start in range(0, len(df), LOAD_BATCH_SIZE):
+        job = client.load_table_from_dataframe(
+            df.iloc[start:start + LOAD_BATCH_SIZE], table_id, job_config=job_config
+        )
+        job.result()  # Wait for completion
 
 
 def prepare_for_bigquery(df, uploaded_by):
@@ -85,7 +112,9 @@ def prepare_for_bigquery(df, uploaded_by):
     - Generate record hashes
     """
     
-    bq_df = df.copy()
+    # Shallow copy - the renames and new metadata columns below only touch bq_df,
+    # so duplicating every value of the caller's frame is unnecessary
+    bq_df = df.copy(deep=False)
     
     # Rename columns to BigQuery-friendly names (no spaces, special chars)
     column_mapping = {
@@ -123,7 +152,7 @@ def prepare_for_bigquery(df, uploaded_by):
         "Validation Status": "Validation_Status"
     }
     
-    bq_df = bq_df.rename(columns=column_mapping)
+    bq_df.columns = [column_mapping.get(col, col) for col in bq_df.columns]
     
     # Add metadata columns
     current_time = datetime.utcnow()
@@ -133,45 +162,66 @@ def prepare_for_bigquery(df, uploaded_by):
     bq_df['last_updated'] = current_time
     
     # Generate record hash for deduplication
-    bq_df['record_hash'] = bq_df.apply(generate_record_hash, axis=1)
+    bq_df['record_hash'] = generate_record_hashes(bq_df)
     
     return bq_df
 
 
-def generate_record_hash(row):
+# Key fields that identify a record, in hash order
+HASH_FIELDS = [
+    'Start_Date', 'Province', 'Municipality_City', 'Barangay',
+    'Activity', 'Materials_Service_Provided', 'Count'
+]
+
+
+def generate_record_hashes(df):
     """
-    Generate a unique hash for a record based on key fields
+    Generate a unique hash for each record based on key fields
     Hash includes: Start_Date, Province, Municipality, Barangay, Activity, Materials, Count
+    
+    The key strings are joined column-wise for all rows at once. Values are
+    str()-ed as Python objects (e.g. Timestamps keep their time part), the same
+    as the earlier per-row version, so existing record_hash values in BigQuery
+    still match.
     """
     
-    hash_fields = [
-        str(row.get('Start_Date', '')),
-        str(row.get('Province', '')),
-        str(row.get('Municipality_City', '')),
-        str(row.get('Barangay', '')),
-        str(row.get('Activity', '')),
-        str(row.get('Materials_Service_Provided', '')),
-        str(row.get('Count', ''))
-    ]
-    
-    hash_string = '|'.join(hash_fields)
-    return hashlib.sha256(hash_string.encode()).hexdigest()
+    joined = None
+    for field in HASH_FIELDS:
+        if field in df.columns:
+            part = df[field].astype(object).map(str).to_numpy()
+        else:
+            part = np.full(len(df), '', dtype=object)
+        joined = part if joined is None else joined + '|' + part
+    
+    return pd.Series(
+        [hashlib.sha256(key.encode()).hexdigest() for key in joined],
+        index=df.index,
+        dtype=object
+    )
 
 
-def get_existing_hashes(client, table_id):
+def get_existing_hashes(client, table_id, hashes):
     """
-    Query BigQuery to get all existing record hashes
+    Query BigQuery for which of the given record hashes already exist.
+    The membership test runs server-side, so only matching hashes come back
+    rather than every hash in the table.
     """
     
     query = f"""
-    SELECT record_hash
+    SELECT DISTINCT record_hash
     FROM `{table_id}`
+    WHERE record_hash IN UNNEST(@hashes)
     """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ArrayQueryParameter("hashes", "STRING", list(hashes))
+        ]
+    )
     
     try:
-        query_job = client.query(query)
+        query_job = client.query(query, job_config=job_config)
         results = query_job.result()
         return set(row.record_hash for row in results)
     except:
         # Table might be empty
-        return set()
\ No newline at end of file
+        return set()
@@ -17,4 +17,10 @@ DEFAULT_SHEET_NAME = "Chapter Relief"
 DEFAULT_HEADER_ROW = 9
 
 # Default mapping Google Sheet URL
-DEFAULT_MAPPING_SHEET_ID = "1m0pZjTc0m4zOVT1Ekyc6FfRSQAcVxNhh-eQzTu1DL2Q"
\ No newline at end of file
+DEFAULT_MAPPING_SHEET_ID = "1m0pZjTc0m4zOVT1Ekyc6FfRSQAcVxNhh-eQzTu1DL2Q"
+
+# Concurrent Google Drive downloads (downloads are latency-bound, not CPU-bound)
+DRIVE_DOWNLOAD_WORKERS = 8
+
+# Retries for transient Google API failures (429 / 5xx) - googleapiclient backs off exponentially
+GOOGLE_API_RETRIES = 5
\ No newline at end of file
@@ -1,8 +1,94 @@
+import io
+import pickle
+import numpy as np
 import pandas as pd
-from utils import is_static_column, fuzzy_match_activity
+from utils import (
+    classify_static_columns, get_activity_choices, fuzzy_match_activities,
+    normalize_column_names, clean_numeric_columns
+)
+from transformations import transform_to_format
 
+# Rust-backed calamine reader is much faster than openpyxl - fall back if it isn't installed
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = 'openpyxl'
 
-def process_single_file(file, mapping_df, sheet_name, header_row, static_columns):
+# Mapping table and its fuzzy matching choices for the current worker process
+# (set once by init_worker)
+_worker_mapping_df = None
+_worker_choices = None
+
+
+def serialize_mapping(mapping_df):
+    """Serialize the mapping table once in the parent process for init_worker"""
+    return pickle.dumps(mapping_df, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def init_worker(mapping_payload):
+    """
+    ProcessPoolExecutor initializer - unpacks the mapping table once per worker
+    so it isn't pickled again with every submitted file. The cleaned fuzzy
+    matching choices are built here too and reused for every file.
+    
+    mapping_payload: bytes from serialize_mapping()
+    """
+    global _worker_mapping_df, _worker_choices
+    _worker_mapping_df = pickle.loads(mapping_payload)
+    _worker_choices = get_activity_choices(_worker_mapping_df)
+
+
+def process_file_bytes(file_bytes, file_name, sheet_name, header_row, static_columns, output_format,
+                       processed_df=None, mapping_df=None, choices=None):
+    """
+    Worker entry point: process one file from its raw bytes and transform it.
+    Pass an already processed_df to skip straight to the transform
+    (e.g. when only the output format changed).
+    
+    mapping_df and choices default to the worker process's (set by init_worker).
+    Pass them explicitly when running on a thread of the app process - module
+    globals there are shared by every session.
+    
+    Returns: (processed DataFrame, output DataFrame), or (None, None) if no valid data
+    """
+    if processed_df is None:
+        file = io.BytesIO(file_bytes)
+        file.name = file_name
+        
+        if mapping_df is None:
+            mapping_df, choices = _worker_mapping_df, _worker_choices
+        processed_df = process_single_file(file, mapping_df, sheet_name, header_row, static_columns,
+                                           choices=choices)
+        if processed_df is None:
+            return None, None
+    
+    return processed_df, transform_to_format(processed_df, output_format)
+
+
+def merge_mapping(melted_df, mapping_df):
+    """
+    Left-join the mapping table onto melted rows by MatchedActivity - same result as
+    melted_df.merge(mapping_df, left_on='MatchedActivity', right_on='RawItemName', how='left').
+    
+    When mapping names are unique (the usual case) this is a plain index lookup,
+    skipping the join machinery. Duplicate names fan rows out, so those still merge.
+    """
+    if not mapping_df['RawItemName'].is_unique:
+        return melted_df.merge(mapping_df, left_on='MatchedActivity', right_on='RawItemName', how='left')
+    
+    mapped = mapping_df.set_index(mapping_df['RawItemName']).reindex(melted_df['MatchedActivity'])
+    mapped.index = pd.RangeIndex(len(mapped))
+    left = melted_df.reset_index(drop=True)
+    
+    # Overlapping column names get merge's default _x/_y suffixes
+    overlap = left.columns.intersection(mapped.columns)
+    left = left.rename(columns={col: f'{col}_x' for col in overlap})
+    mapped = mapped.rename(columns={col: f'{col}_y' for col in overlap})
+    return pd.concat([left, mapped], axis=1)
+
+
+def process_single_file(file, mapping_df, sheet_name, header_row, static_columns, source_name=None, choices=None):
     """
     Process a single Excel file through the full pipeline:
     - Read and unpivot
@@ -10,89 +96,106 @@ def process_single_file(file, mapping_df, sheet_name, header_row, static_columns
     - Match activities with fuzzy matching
     - Merge with mapping table
     
+    file can also be an already-read DataFrame (e.g. a native Google Sheet with
+    cleaned column names), which skips the Excel read entirely. source_name
+    overrides the Source_Filename value. choices are the mapping's fuzzy matching
+    choices from get_activity_choices(), built from mapping_df if not given.
+    
     Returns: DataFrame ready for transformation, or None if no valid data
     """
     
-    try:
-        df = pd.read_excel(
-            file,
-            sheet_name=sheet_name,
-            skiprows=header_row-1,
-            dtype=str
-        )
-
-        # STANDARDIZE COLUMN NAMES - remove extra spaces, strip whitespace
-        df.columns = df.columns.str.strip().str.replace(r'\s+', ' ', regex=True)
-
-        # Clean numeric columns - remove commas and convert
-        numeric_cols = ['COST', 'Quantity', 'People_Per_Beneficiary']
-        for col in numeric_cols:
-            if col in df.columns:
-                df[col] = df[col].astype(str).str.replace(',', '').replace('', None)
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-        
-    except ValueError as e:
-        # Sheet name not found
-        if "Worksheet named" in str(e):
-            raise ValueError(
-                f"❌ Sheet '{sheet_name}' not found in {file.name}. "
-                f"Please check the sheet name or ask the uploader to use the correct template."
+    if isinstance(file, pd.DataFrame):
+        # Already in memory - no need to round-trip through Excel
+        df = file.copy(deep=False)
+    else:
+        try:
+            df = pd.read_excel(
+                file,
+                sheet_name=sheet_name,
+                skiprows=header_row-1,
+                dtype=str,
+                engine=EXCEL_ENGINE
             )
-        else:
-            raise e
-    except Exception as e:
-        raise Exception(f"❌ Error reading {file.name}: {str(e)}. File may be corrupted or in wrong format.")
+
+            # STANDARDIZE COLUMN NAMES - remove extra spaces, strip whitespace
+            df.columns = normalize_column_names(df.columns)
+
+            # Clean numeric columns - remove commas and convert
+            clean_numeric_columns(df)
+        
+        except ValueError as e:
+            # Sheet name not found
+            if "Worksheet named" in str(e):
+                raise ValueError(
+                    f"❌ Sheet '{sheet_name}' not found in {file.name}. "
+                    f"Please check the sheet name or ask the uploader to use the correct template."
+                )
+            else:
+                raise e
+        except Exception as e:
+            raise Exception(f"❌ Error reading {file.name}: {str(e)}. File may be corrupted or in wrong format.")
     
     # BEFORE unpivoting, preserve original row number
     df['_original_row'] = df.index + header_row + 1
     
-    # Identify activity columns using fuzzy matching (exclude our temp column)
-    activity_cols = [col for col in df.columns if not is_static_column(col, static_columns) and col != '_original_row']
+    # Classify every column once (fuzzy-matched against all static columns in a
+    # single batch), then bucket them in column order
+    candidates = [col for col in df.columns if col != '_original_row']
+    static_set = {
+        col for col, is_static in zip(candidates, classify_static_columns(candidates, static_columns))
+        if is_static
+    }
     
-    # Get the static columns that actually exist in this file
-    existing_static_cols = [col for col in df.columns if is_static_column(col, static_columns)]
+    # Get the static columns that actually exist in this file.
+    # Columns are picked by position - names can repeat (blank '' headers, names
+    # that only differed in whitespace, non-text headers that all became NaN)
+    static_pos = [i for i, col in enumerate(df.columns) if col in static_set]
     
-    # Add _original_row to static cols so it survives the unpivot
-    existing_static_cols.append('_original_row')
+    # Identify activity columns (exclude our temp column).
+    # Columns with no values at all are skipped - their melted rows would all be
+    # dropped again by the Count filter
+    has_values = df.notna().any().to_numpy()
+    activity_pos = [
+        i for i, (col, non_empty) in enumerate(zip(df.columns, has_values))
+        if non_empty and col != '_original_row' and col not in static_set
+    ]
+    # pd.melt takes same-named columns together, in order of each name's first
+    # appearance - order the positions the same way
+    name_codes, _ = pd.factorize(df.columns[activity_pos], use_na_sentinel=False)
+    activity_pos = np.asarray(activity_pos, dtype=np.intp)[np.argsort(name_codes, kind='stable')]
+    activity_names = np.asarray(df.columns[activity_pos], dtype=object)
     
-    # Unpivot the activity columns
-    melted_df = pd.melt(
-        df,
-        id_vars=existing_static_cols,
-        value_vars=activity_cols,
-        var_name='RawItemName',
-        value_name='Count'
-    )
-
-    # Add source tracking using preserved row numbers
-    melted_df['Source_Filename'] = file.name if hasattr(file, 'name') else 'Unknown'
-    melted_df['Source_Row_Number'] = melted_df['_original_row']
+    # Unpivot the activity columns - same rows and order as pd.melt followed by the
+    # Count filter, but the counts are cleaned and filtered first so the static
+    # values are only repeated for rows that are kept.
+    # Clean - convert to numeric (blanks become NaN), in melt's column-major order
+    counts = pd.to_numeric(df.iloc[:, activity_pos].to_numpy().ravel(order='F'), errors='coerce')
     
-    # Drop temp column
-    melted_df = melted_df.drop(columns=['_original_row'])
+    # Remove NaN and zeros in one selection (NaN > 0 is False)
+    keep = np.flatnonzero(counts > 0)
+    col_idx, row_idx = np.divmod(keep, len(df))
     
-    # Clean - convert to numeric (blanks become NaN)
-    melted_df['Count'] = pd.to_numeric(melted_df['Count'], errors='coerce')
+    melted_df = df.iloc[row_idx, static_pos].reset_index(drop=True)
+    melted_df['RawItemName'] = activity_names[col_idx]
+    melted_df['Count'] = counts[keep]
 
-    # Remove NaN and zeros
-    melted_df = melted_df[melted_df['Count'].notna()]
-    melted_df = melted_df[melted_df['Count'] > 0]
+    # Add source tracking using preserved row numbers
+    melted_df['Source_Filename'] = source_name or (file.name if hasattr(file, 'name') else 'Unknown')
+    melted_df['Source_Row_Number'] = df['_original_row'].to_numpy()[row_idx]
     
     if melted_df.empty:
         return None
     
-    # Fuzzy match activities to handle typos and variations
-    melted_df['MatchedActivity'] = melted_df['RawItemName'].apply(
-        lambda x: fuzzy_match_activity(x, mapping_df) or x
+    # Fuzzy match activities to handle typos and variations - each distinct
+    # activity name is matched once in a batch, then mapped back onto the rows
+    unique_names = melted_df['RawItemName'].unique()
+    matches = fuzzy_match_activities(unique_names, mapping_df, choices=choices)
+    melted_df['MatchedActivity'] = melted_df['RawItemName'].map(
+        {name: matched or name for name, matched in matches.items()}
     )
     
     # Merge with mapping table
-    melted_df = melted_df.merge(
-        mapping_df,
-        left_on='MatchedActivity',
-        right_on='RawItemName',
-        how='left'
-    )
+    melted_df = merge_mapping(melted_df, mapping_df)
     
     # Keep ALL rows, including unmapped ones
     if melted_df.empty:
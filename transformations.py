@@ -1,6 +1,8 @@
 import pandas as pd
+import numpy as np
 import os
-from thefuzz import process
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
 from unidecode import unidecode
 
 # Load PCode reference data
@@ -8,6 +10,41 @@ script_dir = os.path.dirname(__file__)
 pcode_path = os.path.join(script_dir, 'data', 'phl_adminareas_fixed.csv')
 pcode_df = pd.read_csv(pcode_path)
 
+# PCode lookups built once at import instead of filtering pcode_df for every match.
+# Where names repeat, the first reference row wins (as .iloc[0] on a filter did)
+PROVINCE_NAMES = pcode_df['adm2_clean'].dropna().unique().tolist()
+_province_rows = pcode_df.drop_duplicates('adm2_clean')
+PROVINCE_CODES = dict(zip(
+    _province_rows['adm2_clean'], zip(_province_rows['ADM2_new'], _province_rows['ADM1_EN'])
+))
+MUNICIPALITIES_BY_PROVINCE = {
+    code: names.dropna().unique().tolist()
+    for code, names in pcode_df.groupby('ADM2_new', sort=False)['adm3_clean']
+}
+_municipality_rows = pcode_df.drop_duplicates(['ADM2_new', 'adm3_clean'])
+MUNICIPALITY_CODES = dict(zip(
+    zip(_municipality_rows['ADM2_new'], _municipality_rows['adm3_clean']), _municipality_rows['ADM3_new']
+))
+
+# Units that mean cash assistance (flagged for manual review / costed per recipient)
+CASH_UNITS = ['PESOS', 'PHP', 'CASH', 'PESO']
+
+# Month number -> English month name (what strftime('%B') gives), for a vectorized lookup
+MONTH_NAMES = {
+    1: 'January', 2: 'February', 3: 'March', 4: 'April', 5: 'May', 6: 'June',
+    7: 'July', 8: 'August', 9: 'September', 10: 'October', 11: 'November', 12: 'December'
+}
+
+def first_column(df, *names):
+    """
+    Return the first of the given columns present in df, or None.
+    Unlike nested df.get(a, df.get(b)) calls, later names are only looked up when needed.
+    """
+    for name in names:
+        if name in df.columns:
+            return df[name]
+    return None
+
 def get_clean_names(origin_column):
     new_column = origin_column.str.casefold()
     strings_to_remove = [
@@ -48,6 +85,59 @@ def get_clean_names(origin_column):
     new_column = new_column.str.strip()
     return new_column
 
+# thefuzz's WRatio preprocessing drops characters 128-255 before rapidfuzz's default_process
+_NON_ASCII = {i: None for i in range(128, 256)}
+
+def _full_process(s):
+    """Drop characters 128-255, then lowercase, blank out non-alphanumerics and trim (as thefuzz does)"""
+    return default_process(str(s).translate(_NON_ASCII))
+
+def extract_best(queries, choices, score_cutoff=80):
+    """
+    The best choice for each query, or None below score_cutoff. Same matches as
+    thefuzz.process.extractOne (WRatio with thefuzz's string processing), scored
+    directly in RapidFuzz.
+    Queries identical to a choice after processing are resolved by dict lookup
+    (WRatio only scores 100 for identical strings); the rest are scored in a
+    single RapidFuzz cdist call. Ties keep the first choice, like extractOne.
+    """
+    if not len(queries) or not len(choices):
+        return [None] * len(queries)
+    
+    processed_choices = [_full_process(choice) for choice in choices]
+    exact = {}
+    for idx, processed in enumerate(processed_choices):
+        if processed:
+            exact.setdefault(processed, idx)
+    
+    processed_queries = [_full_process(default_process(query)) for query in queries]
+    results = [
+        choices[exact[processed]] if processed in exact else None
+        for processed in processed_queries
+    ]
+    fuzzy = [i for i, processed in enumerate(processed_queries) if processed not in exact]
+    if not fuzzy:
+        return results
+    
+    # float64 scores so ties and the cutoff compare exactly as extractOne's do
+    scores = process.cdist(
+        [processed_queries[i] for i in fuzzy], processed_choices,
+        scorer=fuzz.WRatio, processor=None, score_cutoff=score_cutoff,
+        dtype=np.float64, workers=-1
+    )
+    best_idx = scores.argmax(axis=1)
+    best_score = scores[np.arange(len(fuzzy)), best_idx]
+    for i, idx, score in zip(fuzzy, best_idx, best_score):
+        if score >= score_cutoff:
+            results[i] = choices[idx]
+    return results
+
+# Match results shared by every add_pcodes call (names repeat across files).
+# cleaned province -> (Prov_CODE, Region); (Prov_CODE, cleaned municipality) -> Mun_Code.
+# None records a name that has no match above the cutoff
+_PROVINCE_MATCHES = {}
+_MUNICIPALITY_MATCHES = {}
+
 def add_pcodes(output_df):
     """Add PCodes by matching location names."""
     
@@ -57,93 +147,114 @@ def add_pcodes(output_df):
         return output_df
     
     # Clean the entire columns first, then filter
-    output_df['province_clean'] = get_clean_names(output_df['Province'].fillna(''))
-    output_df['mun_clean'] = get_clean_names(output_df['Municipality/City'].fillna(''))
-    
-    province_list = pcode_df['adm2_clean'].dropna().unique().tolist()
-    
-    # Match province
-    def match_province(row):
-        if not row['province_clean']:
-            return pd.Series([None, None])
-        
-        match = process.extractOne(row['province_clean'], province_list, score_cutoff=80)
-        
-        if match:
-            matched_name = match[0]
-            pcode_row = pcode_df[pcode_df['adm2_clean'] == matched_name].iloc[0]
-            return pd.Series([pcode_row['ADM2_new'], pcode_row['ADM1_EN']])
-        return pd.Series([None, None])
-    
-    output_df[['Prov_CODE', 'Region']] = output_df[has_province].apply(match_province, axis=1)
-    
-    # Match municipality
-    def match_municipality(row):
-        if not row['mun_clean'] or pd.isna(row['Prov_CODE']):
-            return None
-        
-        mun_list = pcode_df[pcode_df['ADM2_new'] == row['Prov_CODE']]['adm3_clean'].dropna().unique().tolist()
-        match = process.extractOne(row['mun_clean'], mun_list, score_cutoff=80)
-        
-        if match:
-            matched_name = match[0]
-            pcode_row = pcode_df[(pcode_df['ADM2_new'] == row['Prov_CODE']) & 
-                                (pcode_df['adm3_clean'] == matched_name)]
-            if not pcode_row.empty:
-                return pcode_row.iloc[0]['ADM3_new']
-        return None
-    
-    output_df.loc[has_province, 'Mun_Code'] = output_df[has_province].apply(match_municipality, axis=1)
-    
-    # Clean up
-    output_df = output_df.drop(['province_clean', 'mun_clean'], axis=1, errors='ignore')
+    province_clean = get_clean_names(output_df.loc[has_province, 'Province'].fillna(''))
+    mun_clean = get_clean_names(output_df.loc[has_province, 'Municipality/City'].fillna(''))
+    
+    # Match province - each distinct cleaned name is matched once, then mapped back.
+    # Results are kept in _PROVINCE_MATCHES, so later files only match new names
+    province_queries = [
+        name for name in province_clean.unique() if name and name not in _PROVINCE_MATCHES
+    ]
+    for query, matched_name in zip(province_queries, extract_best(province_queries, PROVINCE_NAMES)):
+        _PROVINCE_MATCHES[query] = PROVINCE_CODES[matched_name] if matched_name is not None else None
+    
+    no_match = (None, None)
+    matched = [_PROVINCE_MATCHES.get(name) or no_match for name in province_clean]
+    output_df[['Prov_CODE', 'Region']] = pd.DataFrame(
+        matched, index=province_clean.index, columns=['Prov_CODE', 'Region'], dtype=object
+    )
+    
+    # Match municipality - distinct cleaned names are matched once per province,
+    # against that province's municipalities only (cached like provinces)
+    prov_code = output_df.loc[has_province, 'Prov_CODE']
+    keys = list(zip(prov_code, mun_clean))
+    pairs = pd.DataFrame({'prov_code': prov_code, 'mun_clean': mun_clean})
+    pairs = pairs[
+        pairs['prov_code'].notna() & (pairs['mun_clean'] != '')
+        & ~pd.Series([key in _MUNICIPALITY_MATCHES for key in keys], index=pairs.index)
+    ].drop_duplicates()
+    for code, group in pairs.groupby('prov_code', sort=False):
+        queries = group['mun_clean'].tolist()
+        mun_list = MUNICIPALITIES_BY_PROVINCE.get(code, [])
+        for query, matched_name in zip(queries, extract_best(queries, mun_list)):
+            _MUNICIPALITY_MATCHES[(code, query)] = (
+                MUNICIPALITY_CODES[(code, matched_name)] if matched_name is not None else None
+            )
+    
+    output_df.loc[has_province, 'Mun_Code'] = pd.Series(
+        [_MUNICIPALITY_MATCHES.get(key) for key in keys],
+        index=mun_clean.index, dtype=object
+    )
     
     return output_df
 
-def calculate_beneficiary_units(row):
+def _numeric_column(df, name, default=np.nan):
+    """Column coerced to float (unparseable values -> NaN), or default if it is missing"""
+    if name not in df.columns:
+        return np.full(len(df), default, dtype=float)
+    return pd.to_numeric(df[name], errors='coerce').to_numpy(dtype=float)
+
+
+def _is_cash(df):
+    """Rows whose Unit is a cash unit"""
+    if 'Unit' not in df.columns:
+        return np.zeros(len(df), dtype=bool)
+    return df['Unit'].astype(str).str.strip().str.upper().isin(CASH_UNITS).to_numpy()
+
+
+def calculate_beneficiary_units(df, is_cash=None):
     """
-    Calculate number of beneficiary units (e.g., families, households)
+    Calculate number of beneficiary units (e.g., families, households) for every row
     Formula: Count / Quantity
-    """
-    count = pd.to_numeric(row.get('Count', 0), errors='coerce') or 0
-    quantity = pd.to_numeric(row.get('Quantity'), errors='coerce')
-    unit = str(row.get('Unit', '')).strip().upper()
-    
-    # Flag cash for manual review
-    if unit in ['PESOS', 'PHP', 'CASH', 'PESO']:
-        return None
-    
-    # If Quantity is missing/NA/0, can't calculate
-    if pd.isna(quantity) or quantity == 0:
-        return None
     
-    # Calculate beneficiary units
-    return count / quantity
+    Cash rows (flagged for manual review) and rows with a missing/0 Quantity are NaN.
+    is_cash is the _is_cash(df) mask, if the caller already has it.
+    """
+    if is_cash is None:
+        is_cash = _is_cash(df)
+    count = _numeric_column(df, 'Count', default=0)
+    quantity = _numeric_column(df, 'Quantity')
+    
+    invalid = is_cash | np.isnan(quantity) | (quantity == 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        units = count / quantity
+    return pd.Series(np.where(invalid, np.nan, units), index=df.index)
 
 
-def calculate_individuals(row):
+def calculate_individuals(df, is_cash=None):
     """
-    Calculate number of individuals served
+    Calculate number of individuals served for every row
     Formula: (Count / Quantity) × People_Per_Beneficiary
-    """
-    count = pd.to_numeric(row.get('Count', 0), errors='coerce') or 0
-    quantity = pd.to_numeric(row.get('Quantity'), errors='coerce')
-    people_per_beneficiary = pd.to_numeric(row.get('People_Per_Beneficiary'), errors='coerce')
-    unit = str(row.get('Unit', '')).strip().upper()
-    
-    # Flag cash for manual review
-    if unit in ['PESOS', 'PHP', 'CASH', 'PESO']:
-        return None
     
-    # If any required field is missing, can't calculate
-    if pd.isna(quantity) or quantity == 0:
-        return None
-    if pd.isna(people_per_beneficiary) or people_per_beneficiary == 0:
-        return None
-    
-    # Calculate individuals
-    beneficiary_units = count / quantity
-    return beneficiary_units * people_per_beneficiary
+    Cash rows and rows with a missing/0 Quantity or People_Per_Beneficiary are NaN.
+    is_cash is the _is_cash(df) mask, if the caller already has it.
+    """
+    if is_cash is None:
+        is_cash = _is_cash(df)
+    count = _numeric_column(df, 'Count', default=0)
+    quantity = _numeric_column(df, 'Quantity')
+    people_per_beneficiary = _numeric_column(df, 'People_Per_Beneficiary')
+    
+    invalid = (
+        is_cash |
+        np.isnan(quantity) | (quantity == 0) |
+        np.isnan(people_per_beneficiary) | (people_per_beneficiary == 0)
+    )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        individuals = (count / quantity) * people_per_beneficiary
+    return pd.Series(np.where(invalid, np.nan, individuals), index=df.index)
+
+
+def positive_count_rows(df):
+    """
+    Rows of df whose Count is a positive number (blank/invalid counts count as 0).
+    Returns df itself when every row qualifies - processed files usually already
+    have only positive counts - so the common case costs no copy.
+    """
+    if 'Count' not in df.columns:
+        return df.iloc[:0]
+    keep = pd.to_numeric(df['Count'], errors='coerce').fillna(0).to_numpy() > 0
+    return df if keep.all() else df[keep]
 
 
 def transform_to_output_schema(df):
@@ -154,82 +265,52 @@ def transform_to_output_schema(df):
     Returns: DataFrame with final output columns
     """
     
-    output_df = df.copy()
-
-    # Add validation flag for unmapped activities
-    # Check for null/blank Sector OR placeholder values
-    output_df['Validation Status'] = output_df.apply(
-        lambda row: 'Taxonomy Error' if (
-            pd.isna(row.get('Sector')) or 
-            str(row.get('Sector', '')).strip() == '' or
-            str(row.get('Activity', '')).strip().upper() == 'NEEDS MAPPING' or
-            str(row.get('Sector', '')).strip().upper() == 'NEEDS MAPPING'
-        ) else 'For Validation',
-        axis=1
-    )
+    # Drop zero/blank counts up front so no later step works on rows that are
+    # filtered out anyway. Shallow copy - existing columns are only ever replaced
+    # whole, never written into in place
+    output_df = positive_count_rows(df).copy(deep=False)
 
-    # For unmapped rows, use the same expanded mask
+    # Unmapped activities: null/blank Sector OR placeholder values
+    # Each column is stripped/uppercased once (blank -> '') and the result reused
+    sector = output_df['Sector'].fillna('').astype(str).str.strip().str.upper()
+    activity = output_df['Activity'].fillna('').astype(str).str.strip().str.upper()
     unmapped_mask = (
-        (output_df['Sector'].isna()) | 
-        (output_df['Sector'] == '') | 
-        (output_df['Sector'].str.strip() == '') |
-        (output_df['Activity'].str.strip().str.upper() == 'NEEDS MAPPING') |
-        (output_df['Sector'].str.strip().str.upper() == 'NEEDS MAPPING')
+        sector.eq('') |
+        activity.eq('NEEDS MAPPING') |
+        sector.eq('NEEDS MAPPING')
     )
 
-    # Use RawItemName_x (the original activity name from the raw data)
-    if 'RawItemName_x' in output_df.columns:
-        output_df.loc[unmapped_mask, 'Materials/Service Provided'] = output_df.loc[unmapped_mask, 'RawItemName_x']
-    elif 'RawItemName' in output_df.columns:
-        output_df.loc[unmapped_mask, 'Materials/Service Provided'] = output_df.loc[unmapped_mask, 'RawItemName']
-
-    # Static values
-    output_df['Organisation'] = 'Philippine Red Cross'
-    # Handle both single and double space variations
-    output_df['Implementing Partner/Supported By'] = output_df.get('Relief  Donor', output_df.get('Relief Donor', None))
-    output_df['Phase'] = None
-    
-    # Mapping table columns
-    output_df['Sector/Cluster'] = output_df['Sector']
-    output_df['Sub Sector'] = output_df.get('Sub - Sector', output_df.get('Sub Sector', None))
-    output_df['Activity'] = output_df.get('Activity', None)
-
-    # Only use mapping table value for MAPPED rows (don't overwrite unmapped)
+    # Mapping table value for MAPPED rows, RawItemName_x (the original activity name
+    # from the raw data) for unmapped ones
     mapped_mask = ~unmapped_mask  # Inverse of unmapped
-    output_df.loc[mapped_mask, 'Materials/Service Provided'] = output_df.loc[mapped_mask, 'Assistance? Materials/service']
+    raw_name = first_column(output_df, 'RawItemName_x', 'RawItemName')
+    if raw_name is None:
+        raw_name = output_df.get('Materials/Service Provided', np.nan)
+    materials = output_df['Assistance? Materials/service'].where(mapped_mask, raw_name)
 
-    output_df['Unit'] = output_df.get('Unit', None)
     # Calculate beneficiaries using the new logic
-    output_df['# of Beneficiaries Served'] = output_df.apply(calculate_beneficiary_units, axis=1)
-    output_df['Number of Individuals'] = output_df.apply(calculate_individuals, axis=1)
-
-    
-    def determine_validation_status(row):
-        has_mapping_error = (
-            pd.isna(row.get('Sector')) or 
-            str(row.get('Sector', '')).strip() == '' or
-            str(row.get('Activity', '')).strip().upper() == 'NEEDS MAPPING' or
-            str(row.get('Sector', '')).strip().upper() == 'NEEDS MAPPING'
-        )
-        # Check BOTH beneficiary columns
-        has_beneficiary_error = (
-            pd.isna(row.get('# of Beneficiaries Served')) and 
-            pd.isna(row.get('Number of Individuals'))
-        )
-        has_duplicate_mapping = row.get('Duplicate_Mapping_Flag') == 'DUPLICATE MAPPING'
-        
-        if has_duplicate_mapping:
-            return 'Check - Duplicate Mapping'
-        elif has_mapping_error and has_beneficiary_error:
-            return 'Check'
-        elif has_mapping_error:
-            return 'Check Mapping'
-        elif has_beneficiary_error:
-            return 'Check Beneficiaries'
-        else:
-            return 'For Validation'
-
-    output_df['Validation Status'] = output_df.apply(determine_validation_status, axis=1)
+    # Unit is normalized once - the cash mask is shared by both calculations and Total Cost
+    is_cash = _is_cash(output_df)
+    beneficiaries = calculate_beneficiary_units(output_df, is_cash)
+    individuals = calculate_individuals(output_df, is_cash)
+
+    # Validation status - the mapping check is the same unmapped_mask as above
+    has_beneficiary_error = beneficiaries.isna() & individuals.isna()
+    if 'Duplicate_Mapping_Flag' in output_df.columns:
+        has_duplicate_mapping = output_df['Duplicate_Mapping_Flag'] == 'DUPLICATE MAPPING'
+    else:
+        has_duplicate_mapping = pd.Series(False, index=output_df.index)
+
+    validation_status = np.select(
+        [
+            has_duplicate_mapping,
+            unmapped_mask & has_beneficiary_error,
+            unmapped_mask,
+            has_beneficiary_error,
+        ],
+        ['Check - Duplicate Mapping', 'Check', 'Check Mapping', 'Check Beneficiaries'],
+        default='For Validation'
+    ).astype(object)
 
     
     # Location columns (initialize as None, will be filled by PCodes)
@@ -238,18 +319,10 @@ def transform_to_output_schema(df):
     output_df['Prov_CODE'] = None
     output_df['Municipality/City'] = output_df.get('Municipality/City', None)
     output_df['Mun_Code'] = None
-    output_df['Barangay'] = output_df.get('Barangay', None)
-    output_df['Place Name'] = output_df.get('Location Notes/Place/Evacuation Center', 
-                                            output_df.get('Location Notes/Place /Evacuation Center', None))
 
     # Add PCodes
     output_df = add_pcodes(output_df)
     
-    # Operational columns
-    output_df['DSR Intervention Team'] = None
-    output_df['DSR Unit'] = None
-    output_df['Status'] = None
-    
     # Date handling
     date_columns = ['Date of Activity']
     date_col = None
@@ -259,45 +332,62 @@ def transform_to_output_schema(df):
             break
     
     if date_col:
-        output_df['Start Date'] = pd.to_datetime(output_df[date_col], errors='coerce')
-        output_df['Month'] = output_df['Start Date'].dt.strftime('%B')
+        start_date = pd.to_datetime(output_df[date_col], errors='coerce')
+        month = start_date.dt.month.map(MONTH_NAMES)
     else:
-        output_df['Start Date'] = None
-        output_df['Month'] = None
-    
-    output_df['End Date'] = None
-    
-    # Documentation
-    output_df['Source'] = 'Chapter Statistical Report'
-    output_df['Signature'] = None
-    output_df['Weather System'] = None
-    output_df['Remarks'] = output_df.get('Additional Comments', None)
-    output_df['Date Modified'] = None
-    
-# Financial calculations
-    output_df['Count'] = pd.to_numeric(output_df['Count'], errors='coerce').fillna(0)
-    output_df['ACTIVITY COSTING'] = pd.to_numeric(output_df.get('COST', 0), errors='coerce').fillna(0)
-
-    def calculate_total_cost(row):
-        unit = str(row.get('Unit', '')).strip().upper()
-        count = row.get('Count', 0)
-        activity_cost = row.get('ACTIVITY COSTING', 0)
-        beneficiaries = row.get('# of Beneficiaries Served', 0)
-        
-        # If unit is cash/pesos, multiply beneficiaries × cost per household
-        if unit in ['PESOS', 'PHP', 'CASH', 'PESO']:
-            # Use beneficiaries if available, otherwise fall back to count
-            num_recipients = beneficiaries if pd.notna(beneficiaries) and beneficiaries > 0 else count
-            return num_recipients * activity_cost
-        else:
-            # For items, it's count × unit cost
-            return activity_cost * count
-
-    output_df['Total Cost'] = output_df.apply(calculate_total_cost, axis=1)
-    output_df['QTY'] = output_df['Count']
-
-    # Final safety filter - remove any zeros that shouldn't be there
-    output_df = output_df[output_df['Count'] > 0]
+        start_date = None
+        month = None
+    
+    # Financial calculations
+    count = pd.to_numeric(output_df['Count'], errors='coerce').fillna(0)
+    activity_costing = pd.to_numeric(output_df.get('COST', 0), errors='coerce').fillna(0)
+
+    # Cash rows cost beneficiaries × cost per household (falling back to count when
+    # there are no beneficiaries); item rows cost count × unit cost
+    count_values = count.to_numpy()
+    beneficiary_values = beneficiaries.to_numpy()
+    num_recipients = np.where(beneficiary_values > 0, beneficiary_values, count_values)
+    total_cost = pd.Series(
+        np.where(is_cash, num_recipients, count_values) * activity_costing.to_numpy(),
+        index=output_df.index
+    )
+
+    # Computed and output-only columns are built straight into the final frame below
+    # rather than inserted one at a time into the wide merged frame
+    derived_columns = {
+        # Static values
+        "Organisation": 'Philippine Red Cross',
+        # Handle both single and double space variations
+        "Implementing Partner/Supported By": first_column(output_df, 'Relief  Donor', 'Relief Donor'),
+        "Phase": None,
+        # Mapping table columns
+        "Sector/Cluster": output_df['Sector'],
+        "Sub Sector": first_column(output_df, 'Sub - Sector', 'Sub Sector'),
+        "Unit": output_df.get('Unit', None),
+        "Barangay": output_df.get('Barangay', None),
+        "Materials/Service Provided": materials,
+        "Count": count,
+        "# of Beneficiaries Served": beneficiaries,
+        "Place Name": first_column(output_df, 'Location Notes/Place/Evacuation Center',
+                                   'Location Notes/Place /Evacuation Center'),
+        # Operational columns
+        "DSR Intervention Team": None,
+        "DSR Unit": None,
+        "Status": None,
+        "Start Date": start_date,
+        "End Date": None,
+        # Documentation
+        "Source": 'Chapter Statistical Report',
+        "Signature": None,
+        "Weather System": None,
+        "Remarks": output_df.get('Additional Comments', None),
+        "Date Modified": None,
+        "ACTIVITY COSTING": activity_costing,
+        "Total Cost": total_cost,
+        "Month": month,
+        "Validation Status": validation_status,
+        "Number of Individuals": individuals,
+    }
     
     # Select and order final columns
     final_columns = [
@@ -312,9 +402,16 @@ def transform_to_output_schema(df):
     ]
     
     # Only include columns that exist
-    available_columns = [col for col in final_columns if col in output_df.columns]
-    
-    return output_df[available_columns]
+    result_df = pd.DataFrame(
+        {
+            col: derived_columns[col] if col in derived_columns else output_df[col]
+            for col in final_columns
+            if col in derived_columns or col in output_df.columns
+        },
+        index=output_df.index
+    )
+
+    return result_df
 
 def transform_to_opcen_format(df):
     """
@@ -323,61 +420,64 @@ def transform_to_opcen_format(df):
     Returns: DataFrame with OpCen columns
     """
     
-    output_df = df.copy()
+    # Drop zero/blank counts up front so no later step works on rows that are
+    # filtered out anyway. Shallow copy - existing columns are only ever replaced
+    # whole, never written into in place
+    output_df = positive_count_rows(df).copy(deep=False)
     
-    # Add validation flag for unmapped activities
-    output_df['Validation Status'] = output_df['Sector'].apply(
-        lambda x: 'FOR VALIDATION' if (pd.isna(x) or x == '' or str(x).strip() == '') else 'Validated'
-    )
+    # Unmapped activities: null/blank Sector, checked in one pass over the column.
+    # (The OpCen layout has no Validation Status column, so none is computed.)
+    unmapped_mask = output_df['Sector'].fillna('').astype(str).str.strip().eq('')
 
-    # For unmapped rows, populate with raw activity name
-    unmapped_mask = (output_df['Sector'].isna()) | (output_df['Sector'] == '') | (output_df['Sector'].str.strip() == '')
-    output_df.loc[unmapped_mask, 'Sector/Cluster'] = 'REQUIRES MAPPING'
-
-    # Use RawItemName_x (the original activity name from the raw data)
-    if 'RawItemName_x' in output_df.columns:
-        output_df.loc[unmapped_mask, 'INTERVENTION_TYPE'] = output_df.loc[unmapped_mask, 'RawItemName_x']
-    elif 'RawItemName' in output_df.columns:
-        output_df.loc[unmapped_mask, 'INTERVENTION_TYPE'] = output_df.loc[unmapped_mask, 'RawItemName']
-    
-    # OpCen column mappings
-    output_df['DATE'] = pd.to_datetime(output_df.get('Date of Activity'), format='mixed', errors='coerce')
-    output_df['REGION'] = None  # Will be added via PCodes later
-    output_df['PROVINCE'] = output_df.get('Province', None)
-    output_df['CHAPTER'] = output_df.get('Chapter', None)
-    output_df['MUNICIPALITY'] = output_df.get('Municipality/City', None)
-    output_df['BARANGAY'] = output_df.get('Barangay', None)
-    output_df['EXACT LOCATION'] = output_df.get('Location Notes/Place/Evacuation Center', 
-                                                  output_df.get('Location Notes/Place /Evacuation Center', None))
-    output_df['SERVICE'] = None  # To be added later
-    # Only use mapping table value for MAPPED rows
+    # Mapping table Activity for MAPPED rows, RawItemName_x (the original activity
+    # name from the raw data) for unmapped ones
     mapped_mask = ~unmapped_mask
-    output_df.loc[mapped_mask, 'INTERVENTION_TYPE'] = output_df.loc[mapped_mask, 'Activity']
-        
-    # Calculate QTY and beneficiaries
-    output_df['QTY'] = pd.to_numeric(output_df.get('Count', 0), errors='coerce').fillna(0)
-    output_df['UNIT'] = output_df.get('Unit', None)
-    output_df['MENU'] = output_df.get('Additional Comments', None)
-    output_df['MEALS'] = None
-    output_df['PARTNERS'] = output_df.get('Relief Donor', None)
-    output_df['PLATE NUMBER'] = None
-    output_df['VEHICLE'] = None
-    output_df['LATITUDE'] = None  # Will be added via PCodes later
-    output_df['LONGITUDE'] = None  # Will be added via PCodes later
-    output_df['PHOTO LINK'] = None
-    
-    # Calculate beneficiaries using the same logic as DMS 5W
-    output_df['BENEFICIARIES'] = output_df.apply(calculate_beneficiary_units, axis=1)
-    
-    # Select final columns in correct order
-    opcen_columns = [
-        'DATE', 'REGION', 'PROVINCE', 'CHAPTER', 'MUNICIPALITY', 'BARANGAY',
-        'EXACT LOCATION', 'SERVICE', 'INTERVENTION_TYPE', 'QTY', 'UNIT',
-        'MENU', 'MEALS', 'PARTNERS', 'PLATE NUMBER', 'VEHICLE',
-        'LATITUDE', 'LONGITUDE', 'PHOTO LINK', 'BENEFICIARIES'
-    ]
+    raw_name = first_column(output_df, 'RawItemName_x', 'RawItemName')
+    if raw_name is None:
+        raw_name = np.nan
+    intervention_type = output_df['Activity'].where(mapped_mask, raw_name)
+    
+    # OpCen columns in the correct order, built in one step rather than
+    # inserted one at a time into the wide merged frame
+    opcen_df = pd.DataFrame(
+        {
+            'DATE': pd.to_datetime(output_df.get('Date of Activity'), format='mixed', errors='coerce'),
+            'REGION': None,  # Will be added via PCodes later
+            'PROVINCE': output_df.get('Province', None),
+            'CHAPTER': output_df.get('Chapter', None),
+            'MUNICIPALITY': output_df.get('Municipality/City', None),
+            'BARANGAY': output_df.get('Barangay', None),
+            'EXACT LOCATION': first_column(output_df, 'Location Notes/Place/Evacuation Center',
+                                           'Location Notes/Place /Evacuation Center'),
+            'SERVICE': None,  # To be added later
+            'INTERVENTION_TYPE': intervention_type,
+            # Calculate QTY and beneficiaries
+            'QTY': pd.to_numeric(output_df.get('Count', 0), errors='coerce').fillna(0),
+            'UNIT': output_df.get('Unit', None),
+            'MENU': output_df.get('Additional Comments', None),
+            'MEALS': None,
+            'PARTNERS': output_df.get('Relief Donor', None),
+            'PLATE NUMBER': None,
+            'VEHICLE': None,
+            'LATITUDE': None,  # Will be added via PCodes later
+            'LONGITUDE': None,  # Will be added via PCodes later
+            'PHOTO LINK': None,
+            # Calculate beneficiaries using the same logic as DMS 5W
+            'BENEFICIARIES': calculate_beneficiary_units(output_df),
+        },
+        index=output_df.index
+    )
 
-    # Final safety filter - remove any zeros that shouldn't be there
-    output_df = output_df[output_df['QTY'] > 0]
+    return opcen_df
 
-    return output_df[opcen_columns]
\ No newline at end of file
+def transform_to_format(df, output_format):
+    """
+    Transform processed data into the selected output format.
+    
+    Returns: DataFrame in the DMS 5W or OpCen layout
+    """
+    if output_format == "DMS 5W":
+        return transform_to_output_schema(df)
+    elif output_format == "OpCen DSR Daily Assistance":
+        return transform_to_opcen_format(df)
+    raise ValueError(f"Unknown output format: {output_format}")
@@ -1,109 +1,233 @@
 import io
 import re
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from thefuzz import fuzz
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from rapidfuzz import fuzz, process
+from config import DRIVE_DOWNLOAD_WORKERS, GOOGLE_API_RETRIES
 
+# Google client libraries are imported inside the functions that use them,
+# so the app starts quickly when they aren't needed (e.g. manual uploads)
+
+
+def get_credentials(credentials_dict, scopes):
+    """Service account credentials for the given scopes, parsed once per process"""
+    return _cached_credentials(tuple(sorted(credentials_dict.items())), tuple(scopes))
+
+
+@lru_cache(maxsize=4)
+def _cached_credentials(credentials_items, scopes):
+    from google.oauth2.service_account import Credentials
+    return Credentials.from_service_account_info(dict(credentials_items), scopes=list(scopes))
+
+
+# URL patterns are compiled once instead of on every Streamlit rerun
+_FOLDER_ID_PATTERNS = [
+    re.compile(r'/folders/([a-zA-Z0-9-_]+)'),
+    re.compile(r'id=([a-zA-Z0-9-_]+)'),
+]
+_SHEET_ID_PATTERN = re.compile(r'/spreadsheets/d/([a-zA-Z0-9-_]+)')
+
+
+@lru_cache(maxsize=256)
 def extract_folder_id(url):
     """Extract folder ID from Google Drive URL"""
-    patterns = [
-        r'/folders/([a-zA-Z0-9-_]+)',
-        r'id=([a-zA-Z0-9-_]+)',
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, url)
+    for pattern in _FOLDER_ID_PATTERNS:
+        match = pattern.search(url)
         if match:
             return match.group(1)
     return url  # Assume it's already an ID
 
 
-def download_files_from_drive(folder_id, credentials_dict):
+# googleapiclient services are not thread-safe, so each download thread keeps its own
+_thread_local = threading.local()
+
+
+def _thread_drive_service(creds):
+    """Drive service for the current thread, built once and reused for later downloads"""
+    if getattr(_thread_local, 'drive_creds', None) is not creds:
+        from googleapiclient.discovery import build
+        _thread_local.drive_service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+        _thread_local.drive_creds = creds
+    return _thread_local.drive_service
+
+
+def _download_drive_file(file_id, file_name, creds):
+    """Download a single Drive file into a named BytesIO"""
+    from googleapiclient.http import MediaIoBaseDownload
+    
+    drive_service = _thread_drive_service(creds)
+    request = drive_service.files().get_media(fileId=file_id, supportsAllDrives=True)
+    
+    file_content = io.BytesIO()
+    # The default chunksize (100 MB) already fetches a typical report in one request
+    downloader = MediaIoBaseDownload(file_content, request)
+    
+    done = False
+    while not done:
+        status, done = downloader.next_chunk(num_retries=GOOGLE_API_RETRIES)
+    
+    file_content.seek(0)
+    file_content.name = file_name
+    return file_content
+
+
+def download_files_from_drive(folder_id, credentials_dict, max_workers=DRIVE_DOWNLOAD_WORKERS):
     """Download all Excel files from a Google Drive folder"""
+    from googleapiclient.discovery import build
+    
     SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
-    creds = Credentials.from_service_account_info(credentials_dict, scopes=SCOPES)
+    creds = get_credentials(credentials_dict, SCOPES)
     drive_service = build('drive', 'v3', credentials=creds)
     
     # Query for Excel files in the folder
     query = f"'{folder_id}' in parents and (mimeType='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet' or mimeType='application/vnd.ms-excel') and trashed=false"
     
-    results = drive_service.files().list(
-        q=query,
-        fields="files(id, name)"
-    ).execute()
-    
-    files = results.get('files', [])
+    # Only ask for the fields we use, in pages of up to 1000 (the default is 100).
+    # supportsAllDrives/includeItemsFromAllDrives make Shared Drive folders work too
+    files = []
+    page_token = None
+    while True:
+        results = drive_service.files().list(
+            q=query,
+            fields="nextPageToken, files(id, name)",
+            pageSize=1000,
+            pageToken=page_token,
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True
+        ).execute(num_retries=GOOGLE_API_RETRIES)
+        files.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
     
     if not files:
         return []
     
-    downloaded_files = []
-    
-    for file in files:
-        # Download file
-        request = drive_service.files().get_media(fileId=file['id'])
-        
-        file_content = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_content, request)
-        
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-        
-        file_content.seek(0)
-        file_content.name = file['name']
-        downloaded_files.append(file_content)
+    # Downloads are network-bound, so fetch them concurrently (capped to respect Drive QPS)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+        futures = [
+            executor.submit(_download_drive_file, file['id'], file['name'], creds)
+            for file in files
+        ]
+        downloaded_files = [future.result() for future in futures]
     
     return downloaded_files
 
-from difflib import SequenceMatcher
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
 
-def is_static_column(column_name, static_columns, threshold=90):
+def normalize_column_names(columns):
     """
-    Check if a column name matches any static column using fuzzy matching.
+    Strip column names and collapse inner whitespace runs to one space, in a single
+    pass with a precompiled pattern. Non-string names become NaN, as with
+    columns.str.strip().str.replace(r'\s+', ' ', regex=True).
     """
-    from thefuzz import fuzz
+    return [
+        _WHITESPACE_PATTERN.sub(' ', col.strip()) if isinstance(col, str) else np.nan
+        for col in columns
+    ]
+
+# Mapping columns that hold numbers, possibly written with thousands separators
+NUMERIC_COLUMNS = ['COST', 'Quantity', 'People_Per_Beneficiary']
+
+
+def clean_numeric_columns(df):
+    """
+    Convert the NUMERIC_COLUMNS present in df to numbers in place, removing
+    commas first. Blank or invalid values become NaN.
+    """
+    cols = [col for col in NUMERIC_COLUMNS if col in df.columns]
+    if cols:
+        # One comma-strip over the whole block, then one to_numeric per column
+        df[cols] = df[cols].replace(',', '', regex=True).apply(pd.to_numeric, errors='coerce')
+    return df
+
+
+def classify_static_columns(column_names, static_columns, threshold=90):
+    """
+    Check which column names match a static column using fuzzy matching
+    (RapidFuzz ratio, threshold 0-100). Every column name is scored against
+    every static column in one cdist call.
+    
+    Non-text names (e.g. NaN from numeric headers) are never static.
     
-    # DEBUG - write to file
-    #with open('/tmp/debug_fuzzy.txt', 'a') as f:
-    #    best_match = max(static_columns, key=lambda x: fuzz.ratio(column_name.lower(), x.lower()))
-    #    best_score = fuzz.ratio(column_name.lower(), best_match.lower())
-    #    
-    #    if best_score < threshold:
-    #        f.write(f"REJECTED: '{column_name}' -> best match '{best_match}' = {best_score}%\n")
-    #    else:
-    #        f.write(f"MATCHED: '{column_name}' -> '{best_match}' = {best_score}%\n")
+    Returns: numpy bool array, True where the column is static
+    """
+    column_names = list(column_names)
+    if not column_names or not static_columns:
+        return np.zeros(len(column_names), dtype=bool)
     
-    for static_col in static_columns:
-        similarity = fuzz.ratio(column_name.lower(), static_col.lower())
-        if similarity >= threshold:
-            return True
-    return False
+    # float64 so scores right at the threshold compare exactly like fuzz.ratio's.
+    # Rounded like thefuzz's ratio, so e.g. 89.66 still counts as 90 (np.round
+    # rounds halves to even, like Python's round)
+    scores = process.cdist(
+        [name.lower() if isinstance(name, str) else '' for name in column_names],
+        [static_col.lower() for static_col in static_columns],
+        scorer=fuzz.ratio, dtype=np.float64
+    )
+    return np.round(scores.max(axis=1)) >= threshold
 
-def fuzzy_match_activity(activity_name, mapping_df, threshold=0.90):
+def get_activity_choices(mapping_df):
     """
-    Try to find a matching activity using fuzzy matching
-    Returns the matched RawItemName or None
+    Build the fuzzy matching choices from the mapping table once,
+    so they aren't re-cleaned for every activity being matched.
+    
+    Returns: (original RawItemName values, cleaned lowercase values,
+              dict of cleaned value -> index of its first occurrence)
     """
-    activity_clean = str(activity_name).strip().lower()
+    originals = mapping_df['RawItemName'].tolist()
+    cleaned = [str(mapped_activity).strip().lower() for mapped_activity in originals]
+    exact = {}
+    for idx, value in enumerate(cleaned):
+        exact.setdefault(value, idx)
+    return originals, cleaned, exact
+
+def fuzzy_match_activities(activity_names, mapping_df, threshold=0.90, choices=None):
+    """
+    Find the matching mapping activity for each activity name using fuzzy
+    matching: names that match exactly (after cleaning) are looked up directly,
+    the rest are scored against every mapping activity in one RapidFuzz cdist
+    call (multi-threaded C++). Ties keep the first mapping row.
     
-    best_match = None
-    best_score = 0
+    Returns: dict of activity name -> matched RawItemName (or None)
+    """
+    if choices is None:
+        choices = get_activity_choices(mapping_df)
+    originals, cleaned, exact = choices
     
-    for mapped_activity in mapping_df['RawItemName']:
-        mapped_clean = str(mapped_activity).strip().lower()
-        
-        # Exact match
-        if activity_clean == mapped_clean:
-            return mapped_activity
-        
-        # Fuzzy match
-        similarity = SequenceMatcher(None, activity_clean, mapped_clean).ratio()
-        if similarity > best_score and similarity >= threshold:
-            best_score = similarity
-            best_match = mapped_activity
+    activity_names = list(activity_names)
+    if not activity_names or not cleaned:
+        return {name: None for name in activity_names}
     
-    return best_match
+    # Names that match a mapping activity exactly (after cleaning) are looked up
+    # directly; only the rest are fuzzy matched
+    matches = {}
+    fuzzy_names = []
+    for name in activity_names:
+        query = str(name).strip().lower()
+        if query in exact:
+            matches[name] = originals[exact[query]]
+        else:
+            fuzzy_names.append(name)
+    if not fuzzy_names:
+        return matches
+    
+    queries = [str(name).strip().lower() for name in fuzzy_names]
+    
+    # Scores below the cutoff come back as 0; argmax keeps the first best match
+    scores = process.cdist(
+        queries, cleaned,
+        scorer=fuzz.ratio, processor=None, score_cutoff=threshold * 100, workers=-1
+    )
+    best_idx = scores.argmax(axis=1)
+    best_score = scores[np.arange(len(queries)), best_idx]
+    
+    for name, idx, score in zip(fuzzy_names, best_idx, best_score):
+        matches[name] = originals[idx] if score > 0 else None
+    return matches
 
 def detect_google_link_type(url):
     """
@@ -125,6 +249,7 @@ def detect_google_link_type(url):
         return None
 
 
+@lru_cache(maxsize=256)
 def extract_sheet_id(url):
     """
     Extract Google Sheet ID from URL
@@ -134,16 +259,43 @@ def extract_sheet_id(url):
         
     Returns: Sheet ID string or None
     """
-    import re
-    match = re.search(r'/spreadsheets/d/([a-zA-Z0-9-_]+)', url)
+    match = _SHEET_ID_PATTERN.search(url)
     if match:
         return match.group(1)
     return None
 
 
+def get_sheet_values(sheet_id, credentials_dict, range_name='A:ZZ'):
+    """
+    Read a range from a Google Sheet with a single Sheets API values.get call
+    
+    Args:
+        sheet_id: Google Sheet ID
+        credentials_dict: Service account credentials
+        range_name: A1 range; without a sheet name this reads the first sheet
+        
+    Returns: list of rows, padded with '' to a common width (like gspread)
+    """
+    from googleapiclient.discovery import build
+    
+    SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+    creds = get_credentials(credentials_dict, SCOPES)
+    sheets_service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
+    
+    result = sheets_service.spreadsheets().values().get(
+        spreadsheetId=sheet_id,
+        range=range_name
+    ).execute(num_retries=GOOGLE_API_RETRIES)
+    values = result.get('values', [])
+    
+    # The API drops trailing empty cells, so pad rows back out to the widest row
+    width = max((len(row) for row in values), default=0)
+    return [row + [''] * (width - len(row)) for row in values]
+
+
 def read_google_sheet(sheet_id, credentials_dict, sheet_name='Chapter Relief', header_row=9):
     """
-    Read a Google Sheet directly using gspread API
+    Read a Google Sheet directly with a single Sheets API values.get call
     
     Args:
         sheet_id: Google Sheet ID
@@ -153,56 +305,49 @@ def read_google_sheet(sheet_id, credentials_dict, sheet_name='Chapter Relief', h
         
     Returns: pandas DataFrame
     """
-    from google.oauth2.service_account import Credentials
-    import gspread
-    import pandas as pd
+    from googleapiclient.errors import HttpError
     
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
-    creds = Credentials.from_service_account_info(credentials_dict, scopes=SCOPES)
-    sheets_client = gspread.authorize(creds)
+    # A quoted sheet name as the range reads the whole worksheet (quotes in the
+    # name are doubled, per A1 notation)
+    range_name = "'{}'".format(sheet_name.replace("'", "''"))
     
     try:
-        spreadsheet = sheets_client.open_by_key(sheet_id)
-        
-        try:
-            worksheet = spreadsheet.worksheet(sheet_name)
-        except gspread.exceptions.WorksheetNotFound:
-            available_sheets = [ws.title for ws in spreadsheet.worksheets()]
+        # Formatted values, as gspread's get_all_values returned
+        data = get_sheet_values(sheet_id, credentials_dict, range_name)
+    except HttpError as e:
+        if e.resp.status == 400 and 'Unable to parse range' in str(e):
+            available_sheets = get_sheet_titles(sheet_id, credentials_dict)
             raise ValueError(f"Sheet '{sheet_name}' not found. Available sheets: {available_sheets}")
-        
-        # Get all data as list of lists
-        data = worksheet.get_all_values()
-        
-        if not data or len(data) < header_row:
-            raise ValueError(f"Sheet has insufficient rows (found {len(data)}, need at least {header_row})")
-        
-        # IMPORTANT: gspread uses 1-indexed rows, but Python lists are 0-indexed
-        # So row 9 in Google Sheets = data[8] in Python
-        header_idx = header_row - 1  # Row 9 → index 8
-        headers = data[header_idx]   # Get headers from row 9
-        data_rows = data[header_idx + 1:]  # Get data starting from row 10
-
-        # DEBUG - write to file
-        #with open('/tmp/debug_fuzzy.txt', 'a') as f:
-        #    f.write(f"\n=== GOOGLE SHEET READ DEBUG ===\n")
-        #    f.write(f"Header row (1-indexed): {header_row}\n")
-        #    f.write(f"Header idx (0-indexed): {header_idx}\n")
-        #    f.write(f"Headers from data[{header_idx}]: {headers[:5]}\n")
-        #    f.write(f"First data row: {data_rows[0][:5] if data_rows else 'No data'}\n")
-
-        # Create DataFrame
-        df = pd.DataFrame(data_rows, columns=headers)
-
-        # Clean numeric columns - remove commas and convert
-        numeric_cols = ['COST', 'Quantity', 'People_Per_Beneficiary']
-        for col in numeric_cols:
-            if col in df.columns:
-                df[col] = df[col].astype(str).str.replace(',', '').replace('', None)
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-
-        return df
-        
-    except gspread.exceptions.APIError as e:
         raise Exception(f"Google Sheets API Error: {str(e)}. Check that the sheet is shared and accessible.")
-    except Exception as e:
-        raise
\ No newline at end of file
+    
+    if not data or len(data) < header_row:
+        raise ValueError(f"Sheet has insufficient rows (found {len(data)}, need at least {header_row})")
+    
+    # IMPORTANT: Sheets rows are 1-indexed, but Python lists are 0-indexed
+    # So row 9 in Google Sheets = data[8] in Python
+    header_idx = header_row - 1  # Row 9 → index 8
+    headers = data[header_idx]   # Get headers from row 9
+    data_rows = data[header_idx + 1:]  # Get data starting from row 10
+
+    # Create DataFrame
+    df = pd.DataFrame(data_rows, columns=headers)
+
+    # Clean numeric columns - remove commas and convert
+    clean_numeric_columns(df)
+
+    return df
+
+
+def get_sheet_titles(sheet_id, credentials_dict):
+    """Worksheet titles of a Google Sheet, fetching only the sheet properties"""
+    from googleapiclient.discovery import build
+    
+    SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+    creds = get_credentials(credentials_dict, SCOPES)
+    sheets_service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
+    
+    result = sheets_service.spreadsheets().get(
+        spreadsheetId=sheet_id,
+        fields='sheets.properties.title'
+    ).execute(num_retries=GOOGLE_API_RETRIES)
+    return [sheet['properties']['title'] for sheet in result.get('sheets', [])]